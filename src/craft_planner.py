@@ -1,117 +1,138 @@
 import json
-from collections import namedtuple, defaultdict, OrderedDict
+from collections import namedtuple, defaultdict, deque
 from timeit import default_timer as time
-from math import inf
-from heapq import heappop, heappush
+from math import inf, gcd
+from fractions import Fraction
+from functools import reduce
 
-Recipe = namedtuple('Recipe', ['name', 'check', 'effect', 'cost'])
+Recipe = namedtuple('Recipe', ['name', 'bounds', 'delta', 'cost'])
 
 
-class State(OrderedDict):
-    """ This class is a thin wrapper around an OrderedDict, which is simply a dictionary which keeps the order in
-        which elements are added (for consistent key-value pair comparisons). Here, we have provided functionality
-        for hashing, should you need to use a state as a key in another dictionary, e.g. distance[state] = 5. By
-        default, dictionaries are not hashable. Additionally, when the state is converted to a string, it removes
-        all items with quantity 0.
+# States are packed into a single int: each item gets a field of FIELD_BITS quantity bits plus one guard bit
+# above them, in the order of Crafting['Items'] (see ITEM_INDEX). The guard bits are always 0 in a state;
+# setting them all (GUARD_BITS) before a subtraction lets one int operation compare every field at once.
+FIELD_BITS = 16
+FIELD_WIDTH = FIELD_BITS + 1
+FIELD_MASK = (1 << FIELD_BITS) - 1
 
-        Use of this state representation is optional, should you prefer another.
-    """
 
-    def __key(self):
-        return tuple(self.items())
+def pack(quantities):
+    # Packs a dict of item -> quantity into a state-shaped int.
+    for item, value in quantities.items():
+        if value > FIELD_MASK:
+            raise ValueError('%s quantity %d does not fit in a %d-bit state field' % (item, value, FIELD_BITS))
+    return sum(value << (ITEM_INDEX[item] * FIELD_WIDTH) for item, value in quantities.items())
 
-    def __hash__(self):
-        return hash(self.__key())
 
-    def __lt__(self, other):
-        return self.__key() < other.__key()
+def fields_at_least(state, lower):
+    # True if every field of state is >= the matching field of lower. No field borrows from its
+    # neighbour, since the guard bit is set; it survives the subtraction only if state's field is big enough.
+    return ((state | GUARD_BITS) - lower) & GUARD_BITS == GUARD_BITS
 
-    def copy(self):
-        new_state = State()
-        new_state.update(self)
-        return new_state
 
-    def __str__(self):
-        return str(dict(item for item in self.items() if item[1] > 0))
+def field(state, item):
+    # Unpacks the quantity of one item from a packed state.
+    return (state >> (ITEM_INDEX[item] * FIELD_WIDTH)) & FIELD_MASK
 
 
-def make_checker(rule):
-    # Implement a function that returns a function to determine whether a state meets a
-    # rule's requirements. This code runs once, when the rules are constructed before
-    # the search is attempted.
+def format_state(state):
+    # For printing, unpack the fields back to item names and drop all items with quantity 0.
+    quantities = {item: field(state, item) for item in ITEM_INDEX}
+    return str({item: value for item, value in quantities.items() if value > 0})
 
-    # print(rule)
 
-    def check(state):
-        # This code is called by graph(state) and runs millions of times.
-        # Tip: Do something with rule['Consumes'] and rule['Requires'].
+def net_deltas(rule):
+    # Net change in quantity of each item touched by the rule: produced items positive, consumed items negative.
+    deltas = defaultdict(int)
+    for item, value in rule['Produces'].items():
+        deltas[item] += value
+    for item, value in rule.get('Consumes', {}).items():
+        deltas[item] -= value
+    return deltas
 
-        if 'Consumes' in rule:
-            for item, value in rule['Consumes'].items():
-                if state[item] < value:  # don't have enough of that item
-                    return False
 
-        if 'Requires' in rule:
-            for item, value in rule['Requires'].items():
-                if state[item] == 0:
-                    return False
-        return True
+def rule_bounds(rule):
+    # Returns the packed (lower, upper) bounds a state must lie within for the rule to apply, or None if the rule
+    # can never apply. make_graph() writes the test into graph(state) from these. This code runs once, when the
+    # rules are constructed before the search is attempted.
 
-    return check
+    # Lower bounds: consumed quantities, and at least 1 of every required item.
+    needed = dict(rule.get('Consumes', {}))
+    for item, value in rule.get('Requires', {}).items():
+        if value:
+            needed[item] = max(needed.get(item, 0), 1)
+    lower = pack(needed)
 
+    # Upper bounds: produced items must stay within MAX_ALLOWED after the rule applies. This prunes successors the
+    # heuristic would rule out anyway before they are generated, and (as MAX_ALLOWED <= FIELD_MASK) keeps the
+    # effect from overflowing one field into the next. Other items are left unbounded (FIELD_MASK).
+    produced = {item: value for item, value in net_deltas(rule).items() if value > 0}
+    room = {item: FIELD_MASK for item in ITEM_INDEX}
+    for item, value in produced.items():
+        room[item] = field(MAX_ALLOWED, item) - value
+    if min(room.values()) < 0:  # one application already exceeds a bound
+        return None
+    upper = pack(room)
 
-def make_effector(rule):
-    # Implement a function that returns a function which transitions from state to
-    # new_state given the rule. This code runs once, when the rules are constructed
-    # before the search is attempted.
+    return lower, upper
 
-    def effect(state):
-        # This code is called by graph(state) and runs millions of times
-        # Tip: Do something with rule['Produces'] and rule['Consumes'].
 
-        next_state = State.copy(state)
+def rule_delta(rule):
+    # Returns the transition from state to new_state as one (possibly negative) int to add to the state;
+    # rule_bounds() guarantees no field under/overflows. This code runs once, when the rules are constructed.
 
-        for item, value in rule['Produces'].items():
-            next_state[item] += value  # add item quantity to inventory
-
-        if 'Consumes' in rule:
-            for item, value in rule['Consumes'].items():
-                next_state[item] -= value  # subtract item quantity from inventory
-
-        return next_state
-
-    return effect
+    # Not memoized: search() expands each state once, and a cache lookup costs as much as this one int add.
+    return sum(value << (ITEM_INDEX[item] * FIELD_WIDTH) for item, value in net_deltas(rule).items())
 
 
 def make_goal_checker(goal):
     # Implement a function that returns a function which checks if the state has
     # met the goal criteria. This code runs once, before the search is attempted.
 
+    lower = pack(goal)
+
     def is_goal(state):
         # This code is used in the search process and may be called millions of times.
-        for item, value in goal.items():
-            if state[item] < value:
-                return False
-
-        return True
+        return fields_at_least(state, lower)
 
     return is_goal
 
 
-def graph(state):
+def make_graph(recipe_buckets):
+    # Returns the graph(state) function over the given (requires, recipes) buckets. It is generated code: every
+    # bucket test and every recipe's bounds test and delta are written out inline as int literals, in order, so
+    # a call runs straight-line int arithmetic, with no loop and no function call per recipe.
+    guard = GUARD_BITS
+    lines = ['def graph(state):', '    guarded = state | %d' % guard]
+
     # Iterates through all recipes/rules, checking which are valid in the given state.
     # If a rule is valid, it returns the rule's name, the resulting state after application
     # to the given state, and the cost for the rule.
-    for r in all_recipes:
-        if r.check(state):
-            yield (r.name, r.effect(state), r.cost)
-
-
-def heuristic(state):
-    # Implement your heuristic here!
-
+    # Recipes are bucketed by the tools they require, so whole buckets are skipped when a tool is missing.
+    for requires, recipes in recipe_buckets:
+        recipes = [r for r in recipes if r.bounds is not None]
+        if not recipes:
+            continue
+        lines.append('    if (guarded - %d) & %d == %d:' % (requires, guard, guard))
+        for r in recipes:
+            lower, upper = r.bounds
+            lines.append('        if (guarded - %d) & %d == %d and (%d - state) & %d == %d:'
+                         % (lower, guard, guard, upper | guard, guard, guard))
+            lines.append('            yield (%r, state + %d, %r)' % (r.name, r.delta, r.cost))
+    lines.append('    return')
+    lines.append('    yield  # keeps graph a generator when no recipe can ever apply')
+
+    namespace = {}
+    exec('\n'.join(lines), namespace)
+    return namespace['graph']
+
+
+def make_heuristic_bounds(goal, initial):
     # From hint: If we already have a tool, we don't need to make another one.
     # Or if we have plenty of a material, we don't need any more.
+    # Returns the largest quantity worth holding for each item, packed like a state. A bound is never below the
+    # initial quantity, so a start inventory above a cap doesn't rule out every state that still holds it.
+    # This code runs once, before the search is attempted.
 
     tools = ['furnace', 'bench', 'wooden_pickaxe', 'wooden_axe', 'stone_pickaxe', 'stone_axe', 'iron_pickaxe', 'iron_axe']
     materials_with_heuristic_value = {  # value based on recipe that uses the most of that specific material (eg. furnace requires 8 cobble so we'll likely never need more than 8 at one time)
@@ -124,24 +145,73 @@ def heuristic(state):
         'ingot':  6
     }
 
+    max_allowed = {item: FIELD_MASK for item in ITEM_INDEX}
     for tool in tools:
-        if tool in Crafting["Goal"].keys():
-            upper_limit = max(Crafting["Goal"][tool], 1)
-            if state[tool] > upper_limit:
-                return inf
+        max_allowed[tool] = min(max(goal.get(tool, 0), initial.get(tool, 0), 1), FIELD_MASK)
+    for material, value in materials_with_heuristic_value.items():
+        max_allowed[material] = min(max(goal.get(material, 0), initial.get(material, 0), value), FIELD_MASK)
+
+    return pack(max_allowed)
 
-        elif state[tool] > 1:
-            return inf
 
-    for material in materials_with_heuristic_value.keys():
-        if material in Crafting["Goal"].keys():
-            upper_limit = max(Crafting["Goal"][material], materials_with_heuristic_value[material])
-            if state[material] > upper_limit:
-                return inf
-        elif state[material] > materials_with_heuristic_value[material]:
+def make_heuristic(goal, recipes):
+    # Implement your heuristic here!
+    # Returns a lower bound on the time left to reach the goal, built from a per-unit cost for every item: the
+    # cheapest recipe's time plus the unit costs of what it consumes, divided by how many units it produces. A
+    # recipe with several products splits that total evenly between them. Required tools are never used up, so
+    # they add nothing. No recipe's products are worth more unit cost than its time plus what it consumes, so the
+    # unit cost of the goal minus the unit cost of what we already hold never overestimates.
+    # Held materials count in full, since they can be used up towards the goal. Tools are never consumed, so
+    # only the missing goal tools count. Without that, a spare pickaxe would make the bound weaker.
+
+    producible = {item for rule in recipes.values() for item in rule['Produces']}
+    consumed = {item for rule in recipes.values() for item in rule.get('Consumes', {})}
+
+    # Fixed point for the unit costs, starting from items no recipe makes (there is nothing to relax for them)
+    unit_cost = {item: inf if item in producible else Fraction(0) for item in ITEM_INDEX}
+    for _ in range(len(ITEM_INDEX) + 1):
+        changed = False
+        for rule in recipes.values():
+            total = Fraction(rule['Time']) + sum(value * unit_cost[item] for item, value in rule.get('Consumes', {}).items())
+            share = total / len(rule['Produces'])
+            for item, value in rule['Produces'].items():
+                if share / value < unit_cost[item]:
+                    unit_cost[item] = share / value
+                    changed = True
+        if not changed:
+            break
+    else:  # a recipe cycle that keeps making things cheaper; give up on the estimate
+        unit_cost = {item: Fraction(0) for item in ITEM_INDEX}
+
+    # Items some recipe makes, but only out of other such items, keep an inf cost: they can only come from the
+    # initial inventory. They are left out of the estimate, and so are the rules consuming them (their total
+    # stayed inf above). Those rules could turn a held unit into something worth more than their time, so the
+    # estimate gives up (0) for any state holding one of these items.
+    unpriced = {item for item, cost in unit_cost.items() if cost == inf}
+    unpriced_fields = pack({item: FIELD_MASK for item in unpriced})
+    unit_cost = {item: cost for item, cost in unit_cost.items() if item not in unpriced}
+
+    # Scale to ints so the estimate stays exact; priorities in search() are ints.
+    scale = reduce(lambda a, b: a * b // gcd(a, b), (cost.denominator for cost in unit_cost.values()), 1)
+    weight = {item: int(cost * scale) for item, cost in unit_cost.items()}
+    goal_value = sum(value * weight.get(item, 0) for item, value in goal.items())
+    # (shift, most units that count towards the estimate, weight) for every item that can lower it
+    terms = [(ITEM_INDEX[item] * FIELD_WIDTH, FIELD_MASK if item in consumed else goal.get(item, 0), weight[item])
+             for item in weight if weight[item] and (item in consumed or goal.get(item, 0))]
+    guard = GUARD_BITS
+
+    def heuristic(state):
+        # Any item above its bound in MAX_ALLOWED makes the state useless.
+        if ((MAX_ALLOWED | guard) - state) & guard != guard:
             return inf
+        if state & unpriced_fields:
+            return 0
+        remaining = goal_value
+        for shift, limit, w in terms:
+            remaining -= min((state >> shift) & FIELD_MASK, limit) * w
+        return max(0, -(-remaining // scale))  # rounded up: plan costs are ints
 
-    return 0
+    return heuristic
 
 
 def search(graph, state, is_goal, limit, heuristic):
@@ -153,33 +223,83 @@ def search(graph, state, is_goal, limit, heuristic):
     # representing the path. Each element (tuple) of the list represents a state
     # in the path and the action that took you to this state
 
-    queue = [(0, state, None)]  # This is like the frontier from other assignments, but I don't think it's a frontier if the nodes don't represent a physical space
-    cost = {state: 0}
-    prev = {state: None}
-    actions = {state: None}
+    # This is like the frontier from other assignments, but I don't think it's a frontier if the nodes don't represent a physical space.
+    # Recipe times are small ints, so the queue is a bucket queue (Dial's algorithm): a deque per priority,
+    # and a cursor to the lowest non-empty bucket in place of a heap.
+    queue = defaultdict(deque)
+    queue[0].append(0)
+    queued = 1
+    min_priority = 0
+    # States the heuristic rates inf wait here, and are only expanded once every finite bucket is empty,
+    # the same order a heap would pop them in.
+    unpromising = deque()
+    timed_out = False
+
+    # Each discovered state gets an integer id the first time it is seen; that is the only hashing it costs.
+    # The bookkeeping lives in parallel lists indexed by id, and the queue holds ids.
+    state_id = {state: 0}
+    states = [state]
+    cost = [0]
+    prev = [None]  # id of the state we came from
+    actions = [None]
+    closed = [False]  # already expanded; the queue may still hold stale, worse entries for it
     path = []
 
     # Basic A* implementation
-    while time() - start_time < limit:
+    # Reading the clock every iteration is measurable here, so the time limit is only checked every 4096 iterations.
+    deadline = start_time + limit
+    iterations = 0
+    while queued or unpromising:
+        iterations += 1
+        if iterations & 4095 == 0 and time() > deadline:
+            timed_out = True
+            break
 
-        current_cost, current_state, current_action = heappop(queue)
+        if queued:
+            while not queue[min_priority]:
+                del queue[min_priority]
+                min_priority += 1
+            current_id = queue[min_priority].popleft()
+            queued -= 1
+        else:
+            current_id = unpromising.popleft()
+        if closed[current_id]:
+            continue
+        closed[current_id] = True
+        current_state = states[current_id]
+        current_cost = cost[current_id]
 
         if is_goal(current_state):  # found the goal, now construct the path
-            path.append((current_state, current_action))
-            current_back_node = prev[current_state]
-            while current_back_node is not None:
-                path.insert(0, (current_back_node, actions[current_back_node]))
+            current_back_node = current_id
+            while current_back_node is not None:  # walks back from the goal, so the path is built reversed
+                path.append((states[current_back_node], actions[current_back_node]))
                 current_back_node = prev[current_back_node]
+            path.reverse()
             break
 
         for node_action, node_state, node_cost in graph(current_state):  # graph(current_state) returns all the available actions we can take from our current state. It's like the neighbors
             new_cost = current_cost + node_cost
-            if node_state not in cost or new_cost < cost[node_state]:
-                cost[node_state] = new_cost
-                actions[node_state] = node_action
-                priority = new_cost + heuristic(node_state)
-                heappush(queue, (priority, node_state, node_action))
-                prev[node_state] = current_state
+            node_id = state_id.setdefault(node_state, len(states))  # a single hash lookup, whether new or known
+            if node_id == len(states):
+                states.append(node_state)
+                cost.append(new_cost)
+                prev.append(current_id)
+                actions.append(node_action)
+                closed.append(False)
+            elif new_cost < cost[node_id]:
+                cost[node_id] = new_cost
+                prev[node_id] = current_id
+                actions[node_id] = node_action
+            else:
+                continue
+            priority = new_cost + heuristic(node_state)
+            if priority == inf:  # the heuristic rules this state out, so it has no bucket
+                unpromising.append(node_id)
+                continue
+            queue[priority].append(node_id)
+            queued += 1
+            if priority < min_priority:
+                min_priority = priority
 
     # Failed to find a path
     print(time() - start_time, 'seconds.')
@@ -190,7 +310,10 @@ def search(graph, state, is_goal, limit, heuristic):
         #     print(p[1])
 
         return path
-    print("Failed to find a path from", state, 'within time limit.')
+    if timed_out:
+        print("Failed to find a path from", format_state(state), 'within time limit.')
+    else:
+        print("No path from", format_state(state), 'reaches the goal.')
     return None
 
 
@@ -210,20 +333,34 @@ if __name__ == '__main__':
     # # Dict of crafting recipes (each is a dict):
     # print('Example recipe:','craft stone_pickaxe at bench ->',Crafting['Recipes']['craft stone_pickaxe at bench'])
 
+    # Map each item to its field position in a packed state
+    ITEM_INDEX = {name: i for i, name in enumerate(Crafting['Items'])}
+    GUARD_BITS = sum(1 << (i * FIELD_WIDTH + FIELD_BITS) for i in ITEM_INDEX.values())
+
+    # Upper bounds on useful item quantities, used by the heuristic and the rule bounds
+    MAX_ALLOWED = make_heuristic_bounds(Crafting['Goal'], Crafting['Initial'])
+
     # Build rules
     all_recipes = []
     for name, rule in Crafting['Recipes'].items():
-        checker = make_checker(rule)
-        effector = make_effector(rule)
-        recipe = Recipe(name, checker, effector, rule['Time'])
+        recipe = Recipe(name, rule_bounds(rule), rule_delta(rule), rule['Time'])
         all_recipes.append(recipe)
 
+    # Group rules by the set of tools they require, e.g. everything needing a bench together
+    buckets = defaultdict(list)
+    for recipe, rule in zip(all_recipes, Crafting['Recipes'].values()):
+        requires = pack({item: 1 for item, value in rule.get('Requires', {}).items() if value})
+        buckets[requires].append(recipe)
+    graph = make_graph(buckets.items())
+
     # Create a function which checks for the goal
     is_goal = make_goal_checker(Crafting['Goal'])
 
+    # Create the search heuristic
+    heuristic = make_heuristic(Crafting['Goal'], Crafting['Recipes'])
+
     # Initialize first state from initial inventory
-    state = State({key: 0 for key in Crafting['Items']})
-    state.update(Crafting['Initial'])
+    state = pack(Crafting['Initial'])
 
     # Search for a solution
     resulting_plan = search(graph, state, is_goal, 30, heuristic)
@@ -231,5 +368,5 @@ if __name__ == '__main__':
     if resulting_plan:
         # Print resulting plan
         for state, action in resulting_plan:
-            print('\t', state)
+            print('\t', format_state(state))
             print(action)